@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Compression of the stations stats of a Velib database.
+
+Rows of the ``stationsstats`` table older than the current day are packed in
+a ``stationsstats_compressed`` table, with a single row per station and per
+day (UTC). This is the integer counterpart of the Gorilla time series
+compression:
+    * Timestamps are stored as delta-of-deltas, which are mostly zero as the
+      stats are fetched at a regular interval.
+    * Numbers of bikes, ebikes and free stands, and status IDs, are stored as
+      deltas from the previous value.
+All of these are zigzag-encoded varints. The source rows are then deleted.
+
+This script is meant to run nightly and requires an argument from the
+command-line: the path to the SQLite DB file to compress.
+"""
+import datetime
+import itertools
+import logging
+import os
+import sqlite3
+import sys
+
+# Timestamps larger than this cannot be in seconds (year 5138), while they are
+# in milliseconds starting from 1973
+MIN_TIMESTAMP_MS = 10 ** 11
+
+
+def encode_varints(values, out):
+    """
+    Append signed integers to a buffer, as zigzag-encoded varints.
+
+    :param values: Iterable of integers to encode.
+    :param out: ``bytearray`` to append the encoded values to.
+    """
+    for value in values:
+        value = (value << 1) ^ (value >> 63)  # zigzag
+        while value > 0x7f:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+
+
+def decode_varints(data):
+    """
+    Decode a buffer of zigzag-encoded varints.
+
+    :param data: Buffer to decode.
+    :return: A generator of the decoded integers.
+    """
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        yield (value >> 1) ^ -(value & 1)
+        value = 0
+        shift = 0
+
+
+def compress_rows(rows):
+    """
+    Pack the stats of a station.
+
+    :param rows: List of ``(updated, available_bikes, available_ebikes,
+        free_stands, status)`` tuples, sorted by ``updated``.
+    :return: The packed rows, as ``bytes``.
+    """
+    out = bytearray()
+    encode_varints([len(rows)], out)
+    # Timestamps, as delta-of-deltas
+    previous, previous_delta = 0, 0
+    for updated, *_ in rows:
+        delta = updated - previous
+        encode_varints([delta - previous_delta], out)
+        previous, previous_delta = updated, delta
+    # Other columns, as deltas. A NULL status is stored as 0.
+    for column in range(1, 5):
+        previous = 0
+        for row in rows:
+            value = row[column]
+            if column == 4:
+                value = 0 if value is None else value + 1
+            encode_varints([value - previous], out)
+            previous = value
+    return bytes(out)
+
+
+def decompress_rows(data):
+    """
+    Unpack the stats of a station packed with ``compress_rows``.
+
+    :param data: Packed rows.
+    :return: List of ``(updated, available_bikes, available_ebikes,
+        free_stands, status)`` tuples.
+    """
+    values = decode_varints(data)
+    nb_rows = next(values)
+    columns = []
+    # Timestamps
+    timestamps = []
+    previous, previous_delta = 0, 0
+    for delta_of_delta in itertools.islice(values, nb_rows):
+        previous_delta += delta_of_delta
+        previous += previous_delta
+        timestamps.append(previous)
+    columns.append(timestamps)
+    # Other columns
+    for column in range(1, 5):
+        columns.append(list(itertools.accumulate(
+            itertools.islice(values, nb_rows)
+        )))
+    columns[4] = [None if value == 0 else value - 1 for value in columns[4]]
+    return list(zip(*columns))
+
+
+def get_timestamp_scale(conn):
+    """
+    Get the unit of the ``updated`` timestamps of the stats of a database.
+
+    ``velib.py`` stores them in seconds, but databases dumped by its older
+    versions store the timestamps returned by the API, in milliseconds. The
+    unit is found out from the stored values.
+
+    :param conn: Database connection.
+    :return: Number of ``updated`` units per second, 1 or 1000.
+    """
+    c = conn.cursor()
+    updated, = c.execute("SELECT MAX(updated) FROM stationsstats").fetchone()
+    if updated is None and has_compressed_stats(conn):
+        # All the stats are compressed, use the first compressed timestamp
+        row = c.execute(
+            "SELECT data FROM stationsstats_compressed LIMIT 1"
+        ).fetchone()
+        if row is not None:
+            updated = decompress_rows(row[0])[0][0]
+    if updated is not None and updated >= MIN_TIMESTAMP_MS:
+        return 1000
+    return 1
+
+
+def has_compressed_stats(conn):
+    """
+    Check whether a database has a ``stationsstats_compressed`` table.
+
+    :param conn: Database connection.
+    :return: ``True`` if the table exists.
+    """
+    return conn.execute(
+        """
+        SELECT COUNT(*) FROM sqlite_master
+        WHERE type = 'table' AND name = 'stationsstats_compressed'
+        """
+    ).fetchone()[0] > 0
+
+
+def get_day_start(day):
+    """
+    Get the timestamp of the start of a day.
+
+    :param day: Day (UTC), as a ``YYYY-MM-DD`` string.
+    :return: The timestamp of the start of the day, in seconds.
+    """
+    return int(datetime.datetime.strptime(day, '%Y-%m-%d').replace(
+        tzinfo=datetime.timezone.utc
+    ).timestamp())
+
+
+def iter_compressed_stats(conn, after=None, until=None):
+    """
+    Iterate over the compressed stats of a database, ordered by timestamp.
+
+    Stats are decompressed one day at a time.
+
+    :param conn: Database connection.
+    :param after: Only yield the stats strictly after this timestamp.
+    :param until: Only yield the stats at or before this timestamp.
+    :return: A generator of ``(updated, station_id, available_bikes,
+        available_ebikes, free_stands, status)`` tuples.
+    """
+    if not has_compressed_stats(conn):
+        return
+    scale = get_timestamp_scale(conn)
+    c = conn.cursor()
+    days = [
+        day
+        for day, in c.execute(
+            "SELECT DISTINCT day FROM stationsstats_compressed ORDER BY day"
+        ).fetchall()
+    ]
+    for day in days:
+        start = get_day_start(day) * scale
+        end = start + 24 * 3600 * scale
+        if after is not None and end <= after:
+            continue
+        if until is not None and start > until:
+            break
+        rows = [
+            (row[0], station_id) + row[1:]
+            for station_id, data in c.execute(
+                "SELECT station_id, data FROM stationsstats_compressed WHERE day = ?",
+                (day,)
+            ).fetchall()
+            for row in decompress_rows(data)
+        ]
+        rows.sort(key=lambda row: row[:2])
+        for row in rows:
+            if after is not None and row[0] <= after:
+                continue
+            if until is not None and row[0] > until:
+                break
+            yield row
+
+
+def compress_stats(conn, until):
+    """
+    Compress the stats of the days before a given timestamp.
+
+    Each day is compressed in its own transaction, so that the database is
+    not locked for too long.
+
+    :param conn: Database connection.
+    :param until: Timestamp of the start of the first day to keep as is, in
+        seconds. Must be the start of a day (UTC).
+    """
+    c = conn.cursor()
+    scale = get_timestamp_scale(conn)
+    if scale != 1:
+        logging.info('Stats timestamps are in milliseconds.')
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS stationsstats_compressed(
+          station_id INTEGER,
+          day TEXT,
+          data BLOB,
+          PRIMARY KEY(station_id, day),
+          FOREIGN KEY(station_id) REFERENCES stations(id) ON DELETE CASCADE
+        )
+    """)
+    conn.commit()
+
+    days = [
+        day
+        for day, in c.execute(
+            """
+            SELECT DISTINCT date(updated / ?, 'unixepoch') AS day
+            FROM stationsstats
+            WHERE updated < ?
+            ORDER BY day
+            """,
+            (scale, until * scale)
+        ).fetchall()
+    ]
+    for day in days:
+        logging.info('Compressing stats of %s...', day)
+        start = get_day_start(day) * scale
+        end = start + 24 * 3600 * scale
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            rows = c.execute(
+                """
+                SELECT
+                  station_id,
+                  updated,
+                  available_bikes,
+                  available_ebikes,
+                  free_stands,
+                  status
+                FROM stationsstats
+                WHERE updated >= ? AND updated < ?
+                ORDER BY station_id, updated
+                """,
+                (start, end)
+            ).fetchall()
+            c.executemany(
+                """
+                INSERT INTO
+                stationsstats_compressed(station_id, day, data)
+                VALUES(?, ?, ?)
+                """,
+                (
+                    (
+                        station_id,
+                        day,
+                        compress_rows([row[1:] for row in station_rows])
+                    )
+                    for station_id, station_rows in itertools.groupby(
+                        rows, key=lambda row: row[0]
+                    )
+                )
+            )
+            c.execute(
+                "DELETE FROM stationsstats WHERE updated >= ? AND updated < ?",
+                (start, end)
+            )
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        conn.commit()
+
+
+def main():
+    """
+    Handle main operations.
+    """
+    if len(sys.argv) < 2:
+        sys.exit('Usage: %s db_file' % sys.argv[0])
+
+    # Set up logging, here so that the module can be imported
+    level = logging.WARNING
+    if os.environ.get('DEBUG', False):
+        level = logging.DEBUG
+    logging.basicConfig(level=level)
+
+    # Compress everything up to the start of the current day
+    today = datetime.datetime.now(datetime.timezone.utc).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    conn = sqlite3.connect(sys.argv[1])
+    compress_stats(conn, int(today.timestamp()))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
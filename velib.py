@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
+import collections
+import concurrent.futures
 import datetime
-import json
+import functools
+import itertools
 import logging
+import orjson
 import os
 import requests
 import sqlite3
@@ -11,12 +15,90 @@ import time
 VELIB_STATIONS_INFOS_URL = 'https://velib-metropole-opendata.smoove.pro/opendata/Velib_Metropole/station_information.json'
 VELIB_STATIONS_STATUS_URL = 'https://velib-metropole-opendata.smoove.pro/opendata/Velib_Metropole/station_status.json'
 
+# Delay (in seconds) between two updates
+POLL_INTERVAL = 60
+# Timeout (in seconds) of the requests to the API
+REQUESTS_TIMEOUT = 30
+
+# Maximum number of bound parameters in a single SQLite statement. This is the
+# SQLITE_MAX_VARIABLE_NUMBER default before SQLite 3.32, which is the lowest
+# value we can expect to find.
+SQLITE_MAX_VARIABLES = 999
+# Maximum number of stats rows per multi-row INSERT (6 columns per row)
+MAX_ROWS_PER_BATCH = SQLITE_MAX_VARIABLES // 6
+
+# SQL statements to store the updates
+SQL_UPSERT_STATION = """
+    INSERT INTO
+    stations(
+      id,
+      name,
+      address,
+      latitude,
+      longitude,
+      banking,
+      bonus,
+      bike_stands
+    )
+    VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+      name=excluded.name,
+      latitude=excluded.latitude,
+      longitude=excluded.longitude,
+      banking=excluded.banking,
+      bike_stands=excluded.bike_stands
+"""
+SQL_INSERT_EVENT = """
+    INSERT INTO
+      stationsevents(station_id, timestamp, key, old_value, new_value)
+    VALUES(?, ?, ?, ?, ?)
+"""
+SQL_INSERT_STATS = """
+    INSERT INTO
+    stationsstats(
+      station_id,
+      available_bikes,
+      available_ebikes,
+      free_stands,
+      status,
+      updated
+    )
+    VALUES %s
+"""
+SQL_UPSERT_LAST_STATS = """
+    INSERT OR REPLACE INTO
+    stationsstats_last(
+      station_id,
+      available_bikes,
+      available_ebikes,
+      free_stands,
+      status
+    )
+    VALUES(?, ?, ?, ?, ?)
+"""
+
+# Stored station, as compared against the API
+StationRow = collections.namedtuple(
+    'StationRow',
+    ['id', 'name', 'latitude', 'longitude', 'bike_stands']
+)
+
 # Set up logging
 level = logging.WARNING
 if os.environ.get('DEBUG', False):
     level = logging.DEBUG
 logging.basicConfig(level=level)
 
+# HTTP session, to reuse the same connection for all the API requests
+SESSION = requests.Session()
+SESSION.headers['User-Agent'] = (
+    'VelibDataSet (https://pub.phyks.me/datasets/velib/)'
+)
+SESSION.mount(
+    'https://',
+    requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2)
+)
+
 
 def db_init(db_name=None):
     """
@@ -36,45 +118,149 @@ def db_init(db_name=None):
 
     conn = sqlite3.connect(os.path.join(db_folder, db_name))
     c = conn.cursor()
-    # Init tables
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS stations(
-          id INTEGER,
-          name TEXT,
-          address TEXT,
-          latitude REAL,
-          longitude REAL,
-          banking INTEGER,
-          bonus INTEGER,
-          bike_stands INTEGER
+    # Tune SQLite for our write-heavy workload. WAL with synchronous=NORMAL
+    # avoids a full fsync on each commit, which dominates the update time.
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute("PRAGMA temp_store=MEMORY")
+    c.execute("PRAGMA cache_size=-65536")  # 64MB
+    c.execute("PRAGMA mmap_size=268435456")  # 256MB
+    # Migrate legacy tables and init tables in a single transaction. Python's
+    # sqlite3 does not open transactions before DDL statements, which would
+    # otherwise be committed right away and leave a failed migration halfway.
+    c.execute("BEGIN")
+    try:
+        # Events used to be stored as a JSON list of changes, move such a table
+        # aside to convert it once the new one is created
+        legacy_events = 'event' in (
+            column[1]
+            for column in c.execute("PRAGMA table_info(stationsevents)")
         )
-    """)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS stationsstats(
-          station_id INTEGER,
-          available_bikes INTEGER,
-          available_ebikes INTEGER,
-          free_stands INTEGER,
-          status TEXT,
-          updated INTEGER,
-          FOREIGN KEY(station_id) REFERENCES stations(id) ON DELETE CASCADE
-        )
-    """)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS stationsevents(
-          station_id INTEGER,
-          timestamp INTEGER,
-          event TEXT,
-          FOREIGN KEY(station_id) REFERENCES stations(id) ON DELETE CASCADE
+        if legacy_events:
+            c.execute(
+                "ALTER TABLE stationsevents RENAME TO stationsevents_json"
+            )
+        # Stations used to be stored without a primary key, move such a table
+        # aside as well. Foreign keys of the other tables should keep
+        # referencing the stations table, hence the legacy_alter_table pragma.
+        stations_columns = c.execute("PRAGMA table_info(stations)").fetchall()
+        legacy_stations = (
+            len(stations_columns) > 0
+            and not any(column[5] for column in stations_columns)  # pk flag
         )
-    """)
+        if legacy_stations:
+            c.execute("PRAGMA legacy_alter_table=ON")
+            c.execute("ALTER TABLE stations RENAME TO stations_legacy")
+            c.execute("PRAGMA legacy_alter_table=OFF")
+        # Init tables
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS status_labels(
+              id INTEGER PRIMARY KEY,
+              label TEXT UNIQUE
+            )
+        """)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS stations(
+              id INTEGER PRIMARY KEY,
+              name TEXT,
+              address TEXT,
+              latitude REAL,
+              longitude REAL,
+              banking INTEGER,
+              bonus INTEGER,
+              bike_stands INTEGER
+            )
+        """)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS stationsstats(
+              station_id INTEGER,
+              available_bikes INTEGER,
+              available_ebikes INTEGER,
+              free_stands INTEGER,
+              status INTEGER,
+              updated INTEGER,
+              FOREIGN KEY(station_id) REFERENCES stations(id) ON DELETE CASCADE,
+              FOREIGN KEY(status) REFERENCES status_labels(id)
+            )
+        """)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS stationsstats_last(
+              station_id INTEGER PRIMARY KEY,
+              available_bikes INTEGER,
+              available_ebikes INTEGER,
+              free_stands INTEGER,
+              status TEXT,
+              FOREIGN KEY(station_id) REFERENCES stations(id) ON DELETE CASCADE
+            )
+        """)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS stationsevents(
+              station_id INTEGER,
+              timestamp INTEGER,
+              key TEXT,
+              old_value TEXT,
+              new_value TEXT,
+              FOREIGN KEY(station_id) REFERENCES stations(id) ON DELETE CASCADE
+            )
+        """)
+        if legacy_events:
+            logging.info('Converting stations events to one row per change...')
+            c.executemany(
+                SQL_INSERT_EVENT,
+                (
+                    (
+                        station_id,
+                        timestamp,
+                        change['key'],
+                        change['old_value'],
+                        change['new_value']
+                    )
+                    for station_id, timestamp, event in conn.execute("""
+                        SELECT station_id, timestamp, event
+                        FROM stationsevents_json
+                    """)
+                    for change in orjson.loads(event)
+                )
+            )
+            c.execute("DROP TABLE stationsevents_json")
+        if legacy_stations:
+            logging.info(
+                'Converting stations to a table with a primary key...'
+            )
+            # Stations could be stored multiple times, keep the last stored one
+            c.execute("""
+                INSERT OR REPLACE INTO stations
+                SELECT * FROM stations_legacy ORDER BY rowid
+            """)
+            c.execute("DROP TABLE stations_legacy")
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    return conn
+
+
+def ensure_indexes(conn):
+    """
+    Create the secondary indexes on the stats and events tables.
+
+    These indexes are only useful to query the data. Maintaining them slows
+    down every insert, so they are not created by ``db_init`` and this should
+    be called from analysis scripts instead.
+
+    :param conn: Database connection.
+    """
+    c = conn.cursor()
     c.execute("""
         CREATE INDEX IF NOT EXISTS
           stationstats_station_id ON stationsstats (station_id)
     """)
+    # Covering index for the scans of the stats over time, which also serves
+    # the queries on updated alone
     c.execute("""
         CREATE INDEX IF NOT EXISTS
-          stationsstats_updated ON stationsstats (updated)
+          stationsstats_updated_sid
+          ON stationsstats (updated, station_id, available_bikes)
     """)
     c.execute("""
         CREATE INDEX IF NOT EXISTS
@@ -85,7 +271,53 @@ def db_init(db_name=None):
           stationsevents_timestamp ON stationsevents (timestamp)
     """)
     conn.commit()
-    return conn
+
+
+@functools.lru_cache(maxsize=None)
+def values_placeholders(nb_rows, nb_columns):
+    """
+    Build the placeholders of a multi-row VALUES clause.
+
+    :param nb_rows: Number of rows to insert.
+    :param nb_columns: Number of columns in each row.
+    :return: A string such as ``(?, ?), (?, ?)``.
+    """
+    row = "(%s)" % ", ".join(["?"] * nb_columns)
+    return ", ".join([row] * nb_rows)
+
+
+def get_status_id(c, status_ids, status):
+    """
+    Get the ID of a status label, adding it to the status_labels table if
+    needed.
+
+    :param c: Database cursor.
+    :param status_ids: Mapping of the known labels to their IDs, updated with
+        the added labels.
+    :param status: Status label, can be None.
+    :return: The ID of the label, or None if status is None.
+    """
+    if status is None:
+        return None
+    if status not in status_ids:
+        c.execute("INSERT INTO status_labels(label) VALUES(?)", (status,))
+        status_ids[status] = c.lastrowid
+    return status_ids[status]
+
+
+def count_ebikes(bikes_types):
+    """
+    Get the number of available ebikes of a station.
+
+    :param bikes_types: ``num_bikes_available_types`` field of the station
+        status, a list of single-item dicts such as ``{"ebike": 3}``.
+    :return: The number of available ebikes, 0 if not specified.
+    """
+    for bikes_type in bikes_types:
+        ebikes = bikes_type.get('ebike')
+        if ebikes is not None:
+            return ebikes
+    return 0
 
 
 def update_stations(conn):
@@ -95,178 +327,156 @@ def update_stations(conn):
     :param conn: Database connection.
     """
     c = conn.cursor()
+    # Timestamp of this update, shared by all the inserted rows
+    now_ts = int(time.time())
 
     logging.info('Get all stations from database...')
+    # Note: IDs are stored as integers but are strings in the API responses
     database_stations = {
-        i[0]: i
-        for i in c.execute("""
+        str(row.id): row
+        for row in map(StationRow._make, c.execute("""
             SELECT
               id,
               name,
-              address,
               latitude,
               longitude,
-              banking,
-              bonus,
               bike_stands
             FROM stations
-        """).fetchall()
+        """))
+    }
+
+    logging.info('Get last stored stats from database...')
+    last_stats = {
+        str(i[0]): i[1:]
+        for i in c.execute("""
+            SELECT
+              station_id,
+              available_bikes,
+              available_ebikes,
+              free_stands,
+              status
+            FROM stationsstats_last
+        """)
     }
+    # Status labels are stored as references to the status_labels table
+    status_ids = dict(c.execute("SELECT label, id FROM status_labels"))
 
     logging.info('Get updated Velib stations from API...')
-    req_stations = requests.get(VELIB_STATIONS_INFOS_URL)
+    # Both requests are independent, run them concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        future_stations = executor.submit(
+            SESSION.get, VELIB_STATIONS_INFOS_URL, timeout=REQUESTS_TIMEOUT
+        )
+        future_status = executor.submit(
+            SESSION.get, VELIB_STATIONS_STATUS_URL, timeout=REQUESTS_TIMEOUT
+        )
+        req_stations = future_stations.result()
+        req_status = future_status.result()
     stations = {
         station['stationCode']: station
-        for station in req_stations.json()['data']['stations']
+        for station in orjson.loads(req_stations.content)['data']['stations']
     }
-    req_status = requests.get(VELIB_STATIONS_STATUS_URL)
 
     # List of SQL queries to perform for
-    events = []  # events happening on stations (temporary closure etc)
-    stations_update = []  # Update of stations (such as new stands number)
-    new_stations = []  # New stations to add to the list
-    stats = []  # Current stats of the station
+    events = []  # changes of stations fields (temporary closure etc)
+    # New stations and updates of stations (such as new stands number)
+    stations_update = []
+    stats = []  # Current stats of the station, if they changed
+    new_last_stats = []  # Updated last stats of the stations
 
     logging.info('Processing fetched stations')
-    for station in req_status.json()['data']['stations']:
+    for station in orjson.loads(req_status.content)['data']['stations']:
         uid = station["stationCode"]
-        try:
-            # Get old station entry if it exists
-            old_station = database_stations[uid]
+        infos = stations.get(uid)  # Static informations about the station
+        if infos is None:
+            # Both feeds are not necessarily updated at the same time
+            logging.warning('No informations for station %s, skipping it.', uid)
+            continue
+        # Get old station entry if it exists
+        old_station = database_stations.get(uid)
+        if old_station is not None:
             # Diff the two stations
-            event = []
-            if stations[uid]['name'] != old_station[1]:
-                event.append({"key": "name",
-                              "old_value": old_station[1],
-                              "new_value": stations[uid]['name']})
-            if stations[uid]['latitude'] != old_station[3]:
-                event.append({"key": "latitude",
-                              "old_value": old_station[3],
-                              "new_value": stations[uid]['lat']})
-            if stations[uid]['lon'] != old_station[4]:
-                event.append({"key": "longitude",
-                              "old_value": old_station[4],
-                              "new_value": station[uid]['lon']})
-            if station["numDocksAvailable"] != old_station[7]:
-                event.append({"key": "bike_stands",
-                              "old_value": old_station[7],
-                              "new_value": stations[uid]["capacity"]})
-            # If diff was found
-            if len(event) > 0:
-                stations_update.append(
-                    (
-                        stations[uid]['name'],
-                        stations[uid]['lat'],
-                        stations[uid]['lon'],
-                        None,
-                        stations[uid]['capacity'],
-                        uid
-                    )
-                )
-                events.append(
-                    (
-                        uid,
-                        int(time.time()),
-                        json.dumps(event)
-                    )
-                )
-        except KeyError:
-            # Station is unknown, add it
-            new_stations.append(
+            fields = (
+                ("name", infos['name'], old_station.name),
+                ("latitude", infos['lat'], old_station.latitude),
+                ("longitude", infos['lon'], old_station.longitude),
+                ("bike_stands", infos['capacity'], old_station.bike_stands),
+            )
+            event = [
+                (uid, now_ts, key, old_value, new_value)
+                for key, new_value, old_value in fields
+                if new_value != old_value
+            ]
+            events.extend(event)
+        # Add unknown stations and update the ones for which a diff was found
+        if old_station is None or len(event) > 0:
+            stations_update.append(
                 (
                     uid,
-                    stations[uid]['name'],
+                    infos['name'],
                     "",  # Not available
-                    stations[uid]['lat'],
-                    stations[uid]['lon'],
+                    infos['lat'],
+                    infos['lon'],
                     None,  # Not available
                     False,  # Not available
-                    stations[uid]["capacity"]
+                    infos["capacity"]
                 )
             )
 
         # Add stats
-        numEBikesAvailable = (
-            station['numBikesAvailable']
-            - next(
-                x['ebike']
-                for x in station['num_bikes_available_types']
-                if 'ebike' in x
-            )
+        current_stats = (
+            station['numBikesAvailable'],
+            count_ebikes(station['num_bikes_available_types']),
+            station['numDocksAvailable'],
+            None
         )
-        stats.append(
-            (
-                uid,
-                station['numBikesAvailable'],
-                numEBikesAvailable,
-                station['numDocksAvailable'],
-                None,
-                int(time.time())  # Not available, using current timestamp
+        # Only store stats which changed since the last update
+        if last_stats.get(uid) != current_stats:
+            stats.append(
+                (uid,) + current_stats + (
+                    now_ts,  # Not available, using current timestamp
+                )
             )
-        )
-
-    # Update stations
-    logging.info('Updating stations in db...')
-    c.executemany(
-        """
-        UPDATE
-            stations
-        SET
-            name=?, latitude=?, longitude=?,
-            banking=?, bike_stands=?
-        WHERE id=?
-        """,
-        stations_update
-    )
+            new_last_stats.append((uid,) + current_stats)
 
-    # Insert events in the table
-    logging.info('Insert stations events in db...')
-    c.executemany(
-        """
-        INSERT INTO
-          stationsevents(station_id, timestamp, event)
-        VALUES(?, ?, ?)
-        """,
-        events
-    )
+    # Write everything in a single transaction, so that a failure leaves
+    # the database untouched.
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        # Add the new stations and update the changed ones
+        logging.info('Insert or update stations in db...')
+        c.executemany(
+            SQL_UPSERT_STATION,
+            stations_update
+        )
 
-    # Add the missing stations to database
-    logging.info('Insert missing stations in db...')
-    c.executemany(
-        """
-        INSERT INTO
-        stations(
-          id,
-          name,
-          address,
-          latitude,
-          longitude,
-          banking,
-          bonus,
-          bike_stands
+        # Insert events in the table
+        logging.info('Insert stations events in db...')
+        c.executemany(
+            SQL_INSERT_EVENT,
+            events
         )
-        VALUES(?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        new_stations
-    )
 
-    # Insert stats in database
-    logging.info('Insert stations stats in db...')
-    c.executemany(
-        """
-        INSERT INTO
-        stationsstats(
-          station_id,
-          available_bikes,
-          available_ebikes,
-          free_stands,
-          status,
-          updated
+        # Insert stats in database, using multi-row INSERT statements
+        logging.info('Insert stations stats in db...')
+        stats = [
+            row[:4] + (get_status_id(c, status_ids, row[4]),) + row[5:]
+            for row in stats
+        ]
+        for i in range(0, len(stats), MAX_ROWS_PER_BATCH):
+            batch = stats[i:i + MAX_ROWS_PER_BATCH]
+            c.execute(
+                SQL_INSERT_STATS % values_placeholders(len(batch), 6),
+                tuple(itertools.chain.from_iterable(batch))
+            )
+        # Keep track of the last stored stats
+        c.executemany(
+            SQL_UPSERT_LAST_STATS,
+            new_last_stats
         )
-        VALUES(?, ?, ?, ?, ?, ?)
-        """,
-        stats
-    )
+    except Exception:
+        conn.rollback()
+        raise
 
     # Commit
     conn.commit()
@@ -275,10 +485,37 @@ def update_stations(conn):
 def main():
     """
     Handle main operations.
+
+    Poll the API every ``POLL_INTERVAL`` seconds, keeping the database
+    connection open between the updates.
     """
-    # Get updated list of stations for smovengo
-    conn = db_init()
-    update_stations(conn)
+    conn = None
+    week = None
+    while True:
+        start = time.monotonic()
+
+        try:
+            # Switch to a new database every week
+            current_week = datetime.datetime.now().strftime('%Y-%V')
+            if current_week != week:
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                conn = db_init()
+                week = current_week
+
+            # Get updated list of stations for smovengo
+            update_stations(conn)
+        except (
+            requests.RequestException,
+            ValueError,
+            sqlite3.OperationalError
+        ):
+            # Network errors, invalid API responses and database locked by
+            # another process (such as compress.py), try again next time
+            logging.exception('Unable to update the stations.')
+
+        time.sleep(max(0, POLL_INTERVAL - (time.monotonic() - start)))
 
 
 if __name__ == "__main__":
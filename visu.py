@@ -14,6 +14,15 @@ This script requires a couple of arguments from the command-line:
     * The path to the folder in which generated images should be put.
     * [Optional] A timestamp to start from, to resume operation for instance.
 
+The database is opened read-only. Its stats are much faster to read with the
+indexes of ``velib.ensure_indexes``, which are not created by ``velib.py``.
+Set the ``CREATE_INDEXES`` environment variable to create them first. Only do
+so on a writable copy or on a closed weekly file: building them locks the
+database, and ``velib.py`` would then have to maintain them.
+
+Frames are rendered in parallel, by a pool of worker processes each drawing in
+its own Matplotlib figure.
+
 Note: This code does not take into account the stations events (change of
 station size, new stations, stations deletion). Hence, there might be small
 mistakes in the visualization, such as stations without data. This should be
@@ -21,19 +30,28 @@ handled in an improved version.
 """
 from __future__ import division
 
-import datetime
+import concurrent.futures
+import heapq
+import itertools
 import logging
+import operator
 import os
+import pathlib
 import pickle
 import sqlite3
 import sys
+import time
 
 import matplotlib
 matplotlib.use('AGG')  # Use non-interactive backend
 import matplotlib.pyplot as plt
+import numpy as np
 import progressbar  # progressbar2 pip module
 import smopy
 
+from compress import get_timestamp_scale, iter_compressed_stats
+from matplotlib.collections import PolyCollection
+from PIL import Image
 from scipy.spatial import Voronoi, voronoi_plot_2d
 
 
@@ -50,172 +68,369 @@ def get_hue(percentage):
     return hue / 360.0
 
 
-# Handle arguments from command-line
-if len(sys.argv) < 3:
-    sys.exit('Usage: %s db_file out_dir' % sys.argv[0])
-db_file = sys.argv[1]
-out_dir = sys.argv[2]
-
-# Handle optional first timestamp argument
-first_timestamp = None
-if len(sys.argv) > 3:
-    first_timestamp = int(sys.argv[3])
-
-# Init progressbar and logging
-progressbar.streams.wrap_stderr()  # Required before logging.basicConfig
-logging.basicConfig(level=logging.INFO)
-
-# Ensure out folder exists
-if not os.path.isdir(out_dir):
-    logging.info('Creating output folder %s…', out_dir)
-    os.makedirs(out_dir)
-
-
-# Load all stations from the database
-logging.info('Loading all stations from the database…')
-conn = sqlite3.connect(db_file)
-c = conn.cursor()
-stations = c.execute(
-    "SELECT id, latitude, longitude, bike_stands, name FROM stations"
-).fetchall()
-stations = [
-    station
-    for station in stations
-    if station[1] > 0 and station[2] > 0
-]  # Filter out invalid stations
-logging.info('Loaded %d stations from database.', len(stations))
-
-
-# Set tiles server and params
-smopy.TILE_SERVER = "http://a.tile.stamen.com/toner-lite/{z}/{x}/{y}@2x.png"
-smopy.TILE_SIZE = 512
-smopy.MAXTILES = 25
-
-# Compute map bounds as the extreme stations
-lower_left_corner = (
-    min(station[1] for station in stations),
-    min(station[2] for station in stations)
-)
-upper_right_corner = (
-    max(station[1] for station in stations),
-    max(station[2] for station in stations)
-)
-
-# Get the tiles
-# Note: Force zoom to 12 to still have city names (and not e.g. street names)
-logging.info('Fetching tiles between %s and %s…' % (lower_left_corner, upper_right_corner))
-map = smopy.Map(lower_left_corner + upper_right_corner, z=12)
-
-
-# Compute the station points coordinates
-# (converting from lat/lng to pixels for matplotlib)
-station_points = [
-    map.to_pixels(station[1], station[2]) for station in stations
-]
-
-# Compute Voronoi diagram of available stations
-logging.info('Computing Voronoi diagram of the stations…')
-vor = Voronoi(station_points)
-# This is a mapping between ID of stations and
-# matching Voronoi tile, for faster reuse
-vor_regions = {}
-for point_index, region_index in enumerate(vor.point_region):
-    station_id = stations[point_index][0]
-    region = vor.regions[region_index]
-    if -1 in region:  # Discard regions with points out of bounds
-        continue
-    vor_regions[station_id] = {
-        "polygon": [vor.vertices[i] for i in region],  # Polygon, as a list of points
-        "mpl_surface": None  # Will store the drawn matplotlib surface (to update it easily)
-    }
-# Dumping Voronoi diagram
-voronoi_file = os.path.join(out_dir, 'voronoi.dat')
-with open(voronoi_file, 'wb') as fh:
-    pickle.dump(vor_regions, fh)
-logging.info('Dumped Voronoi diagram to voronoi.dat')
-
-
-# Plotting
-logging.info('Initializing Matplotlib figure…')
-map_img = map.to_pil()
-aspect_ratio = map_img.size[1] / map_img.size[0]
-
-# Create a matplotlib figure
-fig, ax = plt.subplots(figsize=(8, 8 * aspect_ratio))
-ax.set_xticks([])
-ax.set_yticks([])
-ax.grid(False)
-# Compute bounds
-# Note: This is necessary because OSM tiles have some spatial
-# extension and might expand farther than the requested bounds.
-x_min, y_min = map.to_pixels(lower_left_corner)
-x_max, y_max = map.to_pixels(upper_right_corner)
-ax.set_xlim(x_min, x_max)
-ax.set_ylim(y_min, y_max)
-ax.imshow(map_img)
-
-# Initialize Voronoi Matplotlib surfaces to grey
-logging.info('Initializing Voronoi surfaces in the figure…')
-for station_id, region in vor_regions.items():
-    vor_regions[station_id]["mpl_surface"] = ax.fill(
-        alpha=0.25,
-        *zip(*region["polygon"]),
-        color="#9e9e9e"
-    )[0]
-
-# Get time steps
-logging.info('Loading time steps from the database.')
-if first_timestamp:
-    time_data = c.execute(
-        "SELECT DISTINCT updated FROM stationsstats WHERE updated > ? ORDER BY updated ASC",
-        (first_timestamp,)
+# Precompute the color matching each (rounded) percentage of available bikes,
+# as RGBA. Voronoi regions are drawn with an alpha of 0.25.
+COLORS = np.array([
+    tuple(matplotlib.colors.hsv_to_rgb([get_hue(percentage), 1.0, 1.0])) + (0.25,)
+    for percentage in range(101)
+])
+# Color of the Voronoi regions of the stations without data
+NO_DATA_COLOR = matplotlib.colors.to_rgba("#9e9e9e", alpha=0.25)
+
+# Figure of the current rendering worker process, see init_worker
+worker = {}
+
+
+def init_figure(map_img, bounds, polygons):
+    """
+    Create a Matplotlib figure with the map and grey Voronoi regions.
+
+    :param map_img: Image of the map, as an array.
+    :param bounds: ``(x_min, y_min, x_max, y_max)`` bounds of the figure, in
+        pixels of the map image.
+    :param polygons: Voronoi polygon of each station, by index of station
+        (``None`` for stations without any Voronoi region).
+    :return: The figure, its axes, the Matplotlib collection of the Voronoi
+        regions and the array of the indexes of the matching stations.
+    """
+    aspect_ratio = map_img.shape[0] / map_img.shape[1]
+
+    # Create a matplotlib figure
+    fig, ax = plt.subplots(figsize=(8, 8 * aspect_ratio))
+    ax.set_xticks([])
+    ax.set_yticks([])
+    ax.grid(False)
+    x_min, y_min, x_max, y_max = bounds
+    ax.set_xlim(x_min, x_max)
+    ax.set_ylim(y_min, y_max)
+    ax.imshow(map_img)
+
+    # Initialize Voronoi Matplotlib surfaces to grey, as a single collection
+    regions_idx = np.array(
+        [idx for idx, polygon in enumerate(polygons) if polygon is not None],
+        dtype=np.intp
     )
-else:
-    time_data = c.execute(
-        "SELECT DISTINCT updated FROM stationsstats WHERE updated ORDER BY updated ASC"
+    regions = PolyCollection(
+        [polygons[idx] for idx in regions_idx],
+        facecolors=NO_DATA_COLOR,
+        edgecolors=NO_DATA_COLOR
     )
-last_t = None
-timesteps = 5 * 60 * 1000  # 5 mins timesteps between each frames
-
-logging.info('Plotting graphs!')
-bar = progressbar.ProgressBar()
-for t, in bar(time_data):
-    if last_t is None:
-        # Initialize last_t
-        last_t = t
-
-    # For each available station, retrieve its time data
-    c2 = conn.cursor()
-    stations_stats = c2.execute(
-        "SELECT station_id, available_bikes FROM stationsstats WHERE updated=?",
-        (t,)
+    ax.add_collection(regions)
+    return fig, ax, regions, regions_idx
+
+
+def init_worker(map_img, bounds, polygons):
+    """
+    Initialize a rendering worker process, with its own figure.
+
+    Parameters are the same as for ``init_figure``.
+    """
+    fig, ax, regions, regions_idx = init_figure(map_img, bounds, polygons)
+
+    # Render the static parts of the figure (map, axes) once, as a background
+    # on which the Voronoi regions and the title are blitted for each frame
+    regions.set_animated(True)
+    ax.title.set_animated(True)
+    ax.set_title('00/00/0000 00:00')  # Placeholder title, for the layout
+    fig.tight_layout()
+    fig.canvas.draw()
+
+    worker.update(
+        fig=fig,
+        ax=ax,
+        regions=regions,
+        regions_idx=regions_idx,
+        background=fig.canvas.copy_from_bbox(fig.bbox),
+        # Colors of the Voronoi regions, updated in place for each frame
+        colors=np.tile(NO_DATA_COLOR, (len(regions_idx), 1))
     )
 
-    for station_data in stations_stats:
-        # Compute the available bikes percentages for this station over time
-        bike_stands = next(station[3] for station in stations if station[0] == station_data[0])
-        percentage = station_data[1] / bike_stands * 100.0
-        if percentage > 100:
-            # TODO: This happens when a station has changed size inside the
-            # dataset. Should be handled better.
-            percentage = 100
-        # Plot "regions of influence" of the velib stations (Voronoi regions)
-        try:
-            region = vor_regions[station_data[0]]
-            region["mpl_surface"].set_color(matplotlib.colors.hsv_to_rgb([get_hue(percentage), 1.0, 1.0]))
-        except KeyError:
-            # This can happen for a station at the boundaries (we volontarily
-            # ignore them) or for station which disappeared at some point in
-            # the dataset (as we don't handle stations events by now).
-            logging.debug('Unknown Voronoi region for station %d.', station_data[0])
-
-    # Output frame if necessary
-    if t >= last_t + timesteps:
-        ax.set_title(datetime.datetime.fromtimestamp(t // 1000).strftime('%d/%m/%Y %H:%M'))
-        fig.tight_layout()
-        fig.savefig(os.path.join(out_dir, '%d.png' % t))
-        last_t = t
-
-# Output last frame
-fig.tight_layout()
-fig.savefig(os.path.join(out_dir, '%d.png' % t))
+
+def render_frame(percentages, title, out_file):
+    """
+    Render a frame with the figure of the current worker process.
+
+    :param percentages: Array of the (rounded) percentage of available bikes
+        of each station, by index of station (-1 for stations without data).
+    :param title: Title of the frame.
+    :param out_file: Path of the PNG file to write.
+    """
+    # Update the colors of all the Voronoi regions at once
+    colors = worker['colors']
+    percentages = percentages[worker['regions_idx']]
+    has_data = percentages >= 0
+    colors[has_data] = COLORS[percentages[has_data]]
+    worker['regions'].set_facecolors(colors)
+    worker['regions'].set_edgecolors(colors)
+    worker['ax'].set_title(title)
+
+    # Blit the animated artists on top of the background
+    fig, ax = worker['fig'], worker['ax']
+    fig.canvas.restore_region(worker['background'])
+    ax.draw_artist(worker['regions'])
+    for spine in ax.spines.values():  # Keep spines on top of the regions
+        ax.draw_artist(spine)
+    ax.draw_artist(ax.title)
+    # Favor encoding speed over file size, frames are meant to be re-encoded
+    # as a video anyway
+    Image.fromarray(np.asarray(fig.canvas.buffer_rgba())).save(
+        out_file, compress_level=1
+    )
+
+
+def submit_frame(executor, t, timestamp_scale, percentages, out_dir):
+    """
+    Submit the rendering of a frame to the worker processes.
+
+    :param executor: Pool of rendering worker processes.
+    :param t: Timestamp of the frame, as stored in the database.
+    :param timestamp_scale: Number of timestamp units per second.
+    :param percentages: (Rounded) percentage of available bikes of each
+        station, by index of station (-1 for stations without data).
+    :param out_dir: Folder in which the frame should be put.
+    :return: The future of the rendering.
+    """
+    return executor.submit(
+        render_frame,
+        np.array(percentages),  # Copy, as it is pickled later on
+        time.strftime('%d/%m/%Y %H:%M', time.localtime(t // timestamp_scale)),
+        os.path.join(out_dir, '%d.png' % t)
+    )
+
+
+def main():
+    """
+    Handle main operations.
+    """
+    # Handle arguments from command-line
+    if len(sys.argv) < 3:
+        sys.exit('Usage: %s db_file out_dir' % sys.argv[0])
+    db_file = sys.argv[1]
+    out_dir = sys.argv[2]
+
+    # Handle optional first timestamp argument
+    first_timestamp = None
+    if len(sys.argv) > 3:
+        first_timestamp = int(sys.argv[3])
+
+    # Init progressbar and logging
+    progressbar.streams.wrap_stderr()  # Required before logging.basicConfig
+    logging.basicConfig(level=logging.INFO)
+
+    # Ensure out folder exists
+    if not os.path.isdir(out_dir):
+        logging.info('Creating output folder %s…', out_dir)
+        os.makedirs(out_dir)
+
+    # Load all stations from the database
+    logging.info('Loading all stations from the database…')
+    if os.environ.get('CREATE_INDEXES', False):
+        # Imported here as velib.py has its own requirements
+        from velib import ensure_indexes
+        logging.info('Creating indexes…')
+        conn = sqlite3.connect(db_file)
+        ensure_indexes(conn)
+    else:
+        conn = sqlite3.connect(
+            pathlib.Path(db_file).resolve().as_uri() + '?mode=ro', uri=True
+        )
+    c = conn.cursor()
+    # Larger caches speed up the index scans. Note: The journal mode is left
+    # to velib.py (WAL), as setting it would write to the database.
+    c.execute("PRAGMA temp_store=MEMORY")
+    c.execute("PRAGMA cache_size=-65536")  # 64MB
+    c.execute("PRAGMA mmap_size=268435456")  # 256MB
+    stations = c.execute(
+        "SELECT id, latitude, longitude, bike_stands, name FROM stations"
+    ).fetchall()
+    # Coordinates of the stations, as arrays (missing values are NaN)
+    latitudes = np.array([station[1] for station in stations], dtype=np.float64)
+    longitudes = np.array([station[2] for station in stations], dtype=np.float64)
+    # Filter out invalid stations
+    valid = (latitudes > 0) & (longitudes > 0)
+    stations = [station for station, is_valid in zip(stations, valid) if is_valid]
+    latitudes = latitudes[valid]
+    longitudes = longitudes[valid]
+    logging.info('Loaded %d stations from database.', len(stations))
+    # Stations are referred to by their index in the list of valid stations
+    id_to_idx = {station[0]: idx for idx, station in enumerate(stations)}
+    bike_stands_by_idx = [station[3] for station in stations]
+
+    # Set tiles server and params
+    smopy.TILE_SERVER = "http://a.tile.stamen.com/toner-lite/{z}/{x}/{y}@2x.png"
+    smopy.TILE_SIZE = 512
+    smopy.MAXTILES = 25
+
+    # Compute map bounds as the extreme stations
+    lower_left_corner = (float(latitudes.min()), float(longitudes.min()))
+    upper_right_corner = (float(latitudes.max()), float(longitudes.max()))
+
+    # Get the tiles
+    # Note: Force zoom to 12 to still have city names (and not e.g. street names)
+    logging.info('Fetching tiles between %s and %s…' % (lower_left_corner, upper_right_corner))
+    map = smopy.Map(lower_left_corner + upper_right_corner, z=12)
+
+    # Compute the station points coordinates
+    # (converting from lat/lng to pixels for matplotlib, all at once)
+    station_points = np.column_stack(map.to_pixels(latitudes, longitudes))
+
+    # Compute Voronoi diagram of available stations
+    logging.info('Computing Voronoi diagram of the stations…')
+    vor = Voronoi(station_points)
+    # This is a mapping between ID of stations and
+    # matching Voronoi tile, for faster reuse
+    vor_regions = {}
+    for point_index, region_index in enumerate(vor.point_region):
+        station_id = stations[point_index][0]
+        region = vor.regions[region_index]
+        if -1 in region:  # Discard regions with points out of bounds
+            continue
+        vor_regions[station_id] = {
+            "polygon": vor.vertices[region],  # Polygon, as an array of points
+        }
+    # Dumping Voronoi diagram
+    voronoi_file = os.path.join(out_dir, 'voronoi.dat')
+    with open(voronoi_file, 'wb') as fh:
+        pickle.dump(vor_regions, fh)
+    logging.info('Dumped Voronoi diagram to voronoi.dat')
+    # Voronoi region of each station, by index of station
+    regions_by_idx = [vor_regions.get(station[0]) for station in stations]
+
+    # Plotting
+    logging.info('Starting the rendering workers…')
+    map_img = np.asarray(map.to_pil())
+    # Compute bounds
+    # Note: This is necessary because OSM tiles have some spatial
+    # extension and might expand farther than the requested bounds.
+    x_min, y_min = map.to_pixels(lower_left_corner)
+    x_max, y_max = map.to_pixels(upper_right_corner)
+    nb_workers = os.cpu_count() or 1
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=nb_workers,
+        initializer=init_worker,
+        initargs=(
+            map_img,
+            (x_min, y_min, x_max, y_max),
+            [
+                region["polygon"] if region is not None else None
+                for region in regions_by_idx
+            ]
+        )
+    )
+    # Frames being rendered, limited to bound memory usage
+    pending_frames = set()
+    max_pending_frames = 4 * nb_workers
+
+    # Get all the stats, ordered by time step
+    logging.info('Loading stats from the database.')
+    if first_timestamp:
+        # Only the changes are stored, hence start from the last stats of each
+        # station at or before the first timestamp. Uncompressed stats are more
+        # recent than the compressed ones, hence override them.
+        initial_stats = {}
+        for _, station_id, available_bikes in itertools.chain(
+            (
+                row[:3]
+                for row in iter_compressed_stats(conn, until=first_timestamp)
+            ),
+            c.execute(
+                "SELECT MAX(updated), station_id, available_bikes FROM stationsstats WHERE updated <= ? GROUP BY station_id",
+                (first_timestamp,)
+            )
+        ):
+            initial_stats[station_id] = available_bikes
+        stats_data = c.execute(
+            "SELECT updated, station_id, available_bikes FROM stationsstats WHERE updated > ? ORDER BY updated ASC",
+            (first_timestamp,)
+        )
+    else:
+        stats_data = c.execute(
+            "SELECT updated, station_id, available_bikes FROM stationsstats WHERE updated ORDER BY updated ASC"
+        )
+    # Stats of the past days might have been packed by compress.py
+    compressed_stats = (
+        row[:3] for row in iter_compressed_stats(conn, after=first_timestamp)
+    )
+    stats_data = heapq.merge(
+        compressed_stats, stats_data, key=operator.itemgetter(0)
+    )
+    if first_timestamp:
+        # Plot the initial stats as if they were stored at the first timestamp
+        stats_data = itertools.chain(
+            (
+                (first_timestamp, station_id, available_bikes)
+                for station_id, available_bikes in initial_stats.items()
+            ),
+            stats_data
+        )
+    t = None
+    last_t = None
+    last_frame_t = None
+    # Timestamps are in seconds or milliseconds, depending on the database
+    timestamp_scale = get_timestamp_scale(conn)
+    timesteps = 5 * 60 * timestamp_scale  # 5 mins timesteps between each frames
+    # Current percentage of available bikes of each station, by index of
+    # station (-1 until the first stats of the station)
+    percentages = [-1] * len(stations)
+
+    logging.info('Plotting graphs!')
+    bar = progressbar.ProgressBar()
+    for t, stations_stats in bar(itertools.groupby(stats_data, key=operator.itemgetter(0))):
+        if last_t is None:
+            # Initialize last_t
+            last_t = t
+
+        # For each available station, handle its time data
+        for _, station_id, available_bikes in stations_stats:
+            # Compute the available bikes percentages for this station over time
+            idx = id_to_idx.get(station_id)
+            if idx is None:
+                # Filtered out station
+                continue
+            bike_stands = bike_stands_by_idx[idx]
+            if not bike_stands:
+                # Station without any stand
+                continue
+            percentage = available_bikes / bike_stands * 100.0
+            if percentage > 100:
+                # TODO: This happens when a station has changed size inside the
+                # dataset. Should be handled better.
+                percentage = 100
+            # Plot "regions of influence" of the velib stations (Voronoi regions)
+            if regions_by_idx[idx] is None:
+                # This can happen for a station at the boundaries (we volontarily
+                # ignore them) or for station which disappeared at some point in
+                # the dataset (as we don't handle stations events by now).
+                logging.debug('Unknown Voronoi region for station %d.', station_id)
+                continue
+            percentages[idx] = round(percentage)
+
+        # Output frame if necessary
+        if t >= last_t + timesteps:
+            if len(pending_frames) >= max_pending_frames:
+                done, pending_frames = concurrent.futures.wait(
+                    pending_frames,
+                    return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    future.result()  # Raise rendering errors
+            pending_frames.add(submit_frame(
+                executor, t, timestamp_scale, percentages, out_dir
+            ))
+            last_t = t
+            last_frame_t = t
+
+    # Output last frame
+    if t is not None and t != last_frame_t:
+        pending_frames.add(submit_frame(
+            executor, t, timestamp_scale, percentages, out_dir
+        ))
+
+    logging.info('Waiting for the last frames to be rendered…')
+    for future in concurrent.futures.as_completed(pending_frames):
+        future.result()  # Raise rendering errors
+    executor.shutdown()
+
+
+if __name__ == "__main__":
+    main()